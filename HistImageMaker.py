@@ -1,51 +1,280 @@
 # PyTorch
 import torch
-import torchvision.transforms as transforms
 import torch.nn.functional as F
+from torch.utils.data import DataLoader
+
+# TensorRT is optional, the eager model is used if it is not installed
+try:
+    import torch_tensorrt
+except ImportError:
+    torch_tensorrt = None
+
+# Numba is optional, patch positions are parsed with a regex if it is not installed
+try:
+    from numba import njit, prange
+except ImportError:
+    njit = None
+
+# tifffile is optional, only needed to save tiled images
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+# Dataset
+from dataset import PatchDataset, load_image
 
 # Image managing
 from PIL import Image
+import numpy as np
 
 # Paths
 import os
 
+# PNG writing
+import struct
+import zlib
+
+# Parallel image decoding
+from concurrent.futures import ThreadPoolExecutor
+
 # Utils
 from tqdm import tqdm
+import re
+from typing import Tuple, Union
+
+# Number of patches forwarded through the model at once
+BATCH_SIZE = 128
+
+# Number of rows of the image compressed at once when saving it as PNG
+PNG_STRIP = 256
+
+# Number of patches decoded at once when building the original and true labeled images
+DECODE_CHUNK = 1024
+
+# Number of processes used to load the patches while the model is predicting
+NUM_WORKERS = (os.cpu_count() or 2) // 2
+
+# Position of a patch in its file name, e.g. "x1001_y751_class0.png"
+COORDS_PATTERN = re.compile(r'x(\d+)_y(\d+)')
+
+if njit is not None:
+
+    @njit(parallel = True, cache = True)
+    def parse_coords_numba(buffer: np.ndarray, offsets: np.ndarray, x: np.ndarray, y: np.ndarray) -> None:
+        """
+        Gets the position of every patch from its file name, looking for the first "x<digits>_y<digits>" in each one
+
+        Args:
+            buffer (np.ndarray): Bytes of all the file names joined by null bytes
+            offsets (np.ndarray): Position where every file name starts in the buffer, plus one past the end of the buffer
+            x (np.ndarray): Array where the x coordinates are stored (-1 if the name has no position)
+            y (np.ndarray): Array where the y coordinates are stored (-1 if the name has no position)
+        """        
+        for i in prange(len(offsets) - 1):
+            end = offsets[i + 1] - 1
+            x[i], y[i] = -1, -1
+
+            j = offsets[i]
+            while j < end and x[i] < 0:
+
+                # "x" followed by digits
+                if buffer[j] == 120:
+                    k, value_x, digits_x = j + 1, 0, 0
+                    while k < end and 48 <= buffer[k] <= 57:
+                        value_x = value_x * 10 + (buffer[k] - 48)
+                        k += 1
+                        digits_x += 1
+
+                    # "_y" followed by digits
+                    if digits_x > 0 and k + 1 < end and buffer[k] == 95 and buffer[k + 1] == 121:
+                        k, value_y, digits_y = k + 2, 0, 0
+                        while k < end and 48 <= buffer[k] <= 57:
+                            value_y = value_y * 10 + (buffer[k] - 48)
+                            k += 1
+                            digits_y += 1
+
+                        if digits_y > 0:
+                            x[i], y[i] = value_x, value_y
+
+                j += 1
 
 class HistopathologyImageMaker:
-    def __init__(self, model: torch.nn.Module) -> None:
+
+    # Green patch of size 50 x 50, pasted in place of the malignant patches
+    MALIGNANT_PATCH = np.tile(np.array([[0, 255, 0]], dtype = np.uint8), (50 * 50, 1)).reshape(50, 50, 3)
+
+    def __init__(self, model: torch.nn.Module, trt_engine: str = None, tiled_output: bool = False) -> None:
         """
         Constructor for the HistopathologyImageMaker
 
         Args:
             model (torch.nn.Module): Model that will be used to predict the patches in the reconstruction.
+            trt_engine (str, optional): Path where the model compiled with TensorRT (FP16) is cached. If the file does not exist
+                the model is compiled and saved there. None means the model is not compiled. Ignored (the eager model is used)
+                if torch_tensorrt is not installed or there is no GPU. Defaults to None.
+            tiled_output (bool, optional): Save the images as tiled TIFF files instead of PNG, so they can be read by regions
+                without decoding the whole image. Requires tifffile. Defaults to False.
+                In both cases the image is built in a file next to the destination (removed afterwards) and saved by parts,
+                so huge images do not have to fit in memory.
 
         Raises:
             TypeError: The given model is not a torch.nn.Module
+            TypeError: The given TensorRT engine path is not a string
+            TypeError: The given tiled output option is not a bool
+            ImportError: Tiled output was requested but tifffile is not installed
         """  
 
         if not isinstance(model, torch.nn.Module): raise TypeError('"model" must be a torch.nn.Module')
+        if not (trt_engine is None or isinstance(trt_engine, str)): raise TypeError('"trt_engine" must be a str or None')
+        if not isinstance(tiled_output, bool): raise TypeError('"tiled_output" must be a bool')
+        if tiled_output and tifffile is None: raise ImportError('"tiled_output" requires tifffile')
+
+        self.tiled_output = tiled_output
 
         self.device = 'cuda' if torch.cuda.is_available() else 'cpu'
 
         self.model = model.to(self.device)
 
-        self.transforms =  transforms.Compose([
+        # Stream used to copy the predictions back to the CPU
+        self.d2h_stream = torch.cuda.Stream() if self.device == 'cuda' else None
+
+        # Whether the patches must be forwarded in half precision
+        self.half = False
+
+        # Whether the patches must be forwarded in batches of exactly BATCH_SIZE
+        self.fixed_batch = False
+
+        # TensorRT requires a GPU, otherwise keep the eager model
+        if trt_engine is not None and (torch_tensorrt is None or self.device != 'cuda'):
+            print("TensorRT " + ("is not installed" if torch_tensorrt is None else "requires a GPU") + ", using the eager model instead of " + trt_engine)
+
+        if trt_engine is not None and torch_tensorrt is not None and self.device == 'cuda':
+            self.model = self.build_trt_model(trt_engine)
+            self.half = True
+            self.fixed_batch = True
+
+        # Otherwise use channels last (faster cuDNN kernels)
+        else:
+            self.model = self.model.to(memory_format = torch.channels_last)
 
-            # Convert to tensor
-            transforms.ToTensor(),
+        # Whether the model must be compiled before predicting the first image (only on GPU and if the PyTorch version allows it)
+        self.compile_pending = not self.half and self.device == 'cuda' and hasattr(torch, 'compile')
 
-            # Normalize train dataset with its mean and standard deviation
-            transforms.Normalize((0.7595, 0.5646, 0.6882), (0.1496, 0.1970, 0.1428))
-        ])
+        # Mean and standard deviation of the train dataset, scaled to normalize uint8 patches directly on the device
+        dtype = torch.half if self.half else torch.float
+        self.mean = torch.tensor([0.7595, 0.5646, 0.6882], device = self.device, dtype = dtype).view(1, 3, 1, 1) * 255.0
+        self.inv_std = (1.0 / torch.tensor([0.1496, 0.1970, 0.1428], device = self.device, dtype = dtype).view(1, 3, 1, 1)) / 255.0
 
         return
+
+    def build_trt_model(self, trt_engine: str) -> torch.nn.Module:
+        """
+        Compiles the model with TensorRT in FP16 for a fixed batch size, or loads it if it was already compiled
+
+        Args:
+            trt_engine (str): Path where the compiled model is cached
+
+        Returns:
+            torch.nn.Module: The compiled model
+        """        
+        if os.path.isfile(trt_engine):
+            return torch.jit.load(trt_engine).to(self.device)
+
+        self.model.eval()
+
+        # The input shape is fixed so TensorRT can specialize the kernels for it
+        trt_model = torch_tensorrt.compile(self.model, ir = 'ts',
+                                           inputs = [torch_tensorrt.Input((BATCH_SIZE, 3, 50, 50), dtype = torch.half)],
+                                           enabled_precisions = {torch.half})
+
+        torch.jit.save(trt_model, trt_engine)
+        return trt_model
     
-    def build_histopathological_image(self, dir: str, dst: str) -> None:
+    def compile_model(self) -> None:
         """
-        Builds an histopathological image given its patches
+        Compiles the model with torch.compile, keeping the eager model if it can not be compiled
+
+        Raises:
+            RuntimeError: A CUDA error happened while compiling or warming up the model
+
+        Returns:
+            None
+        """        
+        self.compile_pending = False
+
+        try:
+            compiled_model = torch.compile(self.model, mode = 'reduce-overhead', fullgraph = False)
+
+            # Warm up with a full batch, compilation is lazy so this is where it can fail
+            self.model.eval()
+            with torch.no_grad():
+                compiled_model(torch.zeros(BATCH_SIZE, 3, 50, 50, device = self.device).to(memory_format = torch.channels_last))
+
+        except Exception as error:
+
+            # CUDA errors (e.g. out of memory capturing the graph) can leave the device unusable for the eager model too
+            if isinstance(error, torch.cuda.OutOfMemoryError) or 'CUDA error' in str(error): raise
+
+            print("Could not compile the model, using the eager model instead: " + repr(error))
+            return
+
+        self.model = compiled_model
+        self.fixed_batch = True
+        return
+
+    def _parse_coords(self, img_dir: list) -> Tuple[list, list, int, int]:
+        """
+        Gets the position of every patch from its file name
 
         Args:
+            img_dir (list): List with the file names of the patches
+
+        Returns:
+            list: x coordinate of every patch
+            list: y coordinate of every patch
+            int: Maximum x coordinate
+            int: Maximum y coordinate
+
+        Raises:
+            ValueError: The position of a patch could not be found in its file name
+        """        
+        if len(img_dir) == 0:
+            return [], [], 0, 0
+
+        if njit is not None:
+
+            # Join all the names in a single buffer, the separators give where every name starts
+            buffer = np.frombuffer('\0'.join(img_dir).encode(), dtype = np.uint8)
+            offsets = np.concatenate(([0], np.flatnonzero(buffer == 0) + 1, [len(buffer) + 1]))
+
+            x, y = np.empty(len(img_dir), dtype = np.int32), np.empty(len(img_dir), dtype = np.int32)
+            parse_coords_numba(buffer, offsets, x, y)
+            coords = np.stack((x, y), axis = 1)
+
+            # Names without position are marked with -1
+            invalid = np.flatnonzero(x < 0)
+            invalid_idx = int(invalid[0]) if len(invalid) > 0 else None
+
+        else:
+            matches = [COORDS_PATTERN.search(img) for img in img_dir]
+            invalid_idx = matches.index(None) if None in matches else None
+
+            if invalid_idx is None:
+                coords = np.array([match.groups() for match in matches], dtype = np.int32)
+
+        if invalid_idx is not None: raise ValueError('The position of the patch "' + img_dir[invalid_idx] + '" could not be found in its file name')
+
+        max_x, max_y = coords.max(axis = 0)
+
+        return coords[:, 0].tolist(), coords[:, 1].tolist(), int(max_x), int(max_y)
+
+    def _build(self, mode: str, dir: str, dst: str) -> None:
+        """
+        Builds an histopathological image given its patches, pasting each patch or a green patch if it is malignant
+
+        Args:
+            mode (str): "original" pastes every patch, "true" uses the labels of the patches and "predicted" uses the model to predict them
             dir (str): Path to the image patches
             dst (str): Name of destination image
 
@@ -53,6 +282,8 @@ class HistopathologyImageMaker:
             TypeError: The given path is not a string
             TypeError: The given destination is not a string
             OSError: The given path is not a directory
+            ValueError: The given mode is not valid
+            ValueError: The given path has no patches
 
         Returns:
             None
@@ -60,182 +291,311 @@ class HistopathologyImageMaker:
         if not os.path.isdir(dir): raise OSError ('"dir" is not a directory')
         if not isinstance(dir, str): raise TypeError('"dir" must be a string')
         if not isinstance(dst, str): raise TypeError('"dst" must be a string')
+        if mode not in ('original', 'true', 'predicted'): raise ValueError('"mode" must be "original", "true" or "predicted"')
 
         # Get image paths
         img_dir = os.listdir(dir)
+        if len(img_dir) == 0: raise ValueError('"dir" has no patches')
 
-        x_list, y_list = [], []
-        max_x, max_y = 0, 0
-        for img in tqdm(img_dir, desc = "Gathering data..."):
-            
-            # Get image position
-            x, y = img[1:-10].split('y')
-            x,y = int(x [:-1]), int(y [:-1])
+        # Get image positions (no image is opened)
+        x_list, y_list, max_x, max_y = self._parse_coords(img_dir)
 
-            x_list.append(x)
-            y_list.append(y)
+        # Sort patches in Z-order so consecutive patches are pasted in nearby regions of the canvas
+        order = self._morton_order(x_list, y_list)
+        img_dir = [img_dir[i] for i in order]
+        x_list = [x_list[i] for i in order]
+        y_list = [y_list[i] for i in order]
 
-            if x > max_x:
-                max_x = x
-                
-            if y > max_y:
-                max_y = y
+        # Make a blank image of size max_x and max_y (patches at the border are cropped when pasted)
+        # It is backed by a file so the OS can evict the pages that are not being used, instead of keeping the whole image in memory
+        canvas = np.memmap(dst + ".raw", dtype = np.uint8, mode = 'w+', shape = (max_y, max_x, 3))
 
-        #  Make a blank image of size max_x and max_y
-        hist_image = Image.new(mode = 'RGB', size =  (max_x, max_y), color = (255,255,255))
+        try:
+            canvas[:] = 255
 
-        for idx in tqdm(range(len(img_dir)), desc = "Building original image..."):
-        
-            # Open image
-            img = Image.open(dir + img_dir[idx])
+            if mode == 'predicted':
+                self._paste_predicted(canvas, dir, img_dir, x_list, y_list)
 
-            # Paste image at its position
-            hist_image.paste(img, (x_list[idx], y_list[idx]))
+            else:
+                # Images are decoded by a pool of threads (PIL releases the GIL) and pasted in order as they are ready
+                # Only DECODE_CHUNK images are decoded at once, so memory does not grow with the number of patches
+                with ThreadPoolExecutor(max_workers = os.cpu_count()) as executor:
+                    for base in tqdm(range(0, len(img_dir), DECODE_CHUNK), desc = "Building original image..." if mode == 'original' else "Building true labeled image..."):
 
-        # Save image
-        hist_image.save(dst + ".png")
-        return 
+                        # Label is only checked when building the true labeled image, malignant patches are not opened
+                        futures = [None if mode == 'true' and img [-5] != "0" else executor.submit(self._load_patch, dir + img)
+                                   for img in img_dir[base:base + DECODE_CHUNK]]
 
-    def build_truelabel_histopathological_image(self, dir: str, dst: str) -> None:
+                        for idx, future in enumerate(futures, base):
+                            self._paste(canvas, self.MALIGNANT_PATCH if future is None else future.result(), x_list[idx], y_list[idx])
+
+            # Save image
+            if self.tiled_output:
+                tifffile.imwrite(dst + ".tif", canvas, tile = (256, 256))
+            else:
+                self._save_png(canvas, dst + ".png")
+
+        finally:
+            # Remove the file backing the canvas, even if the image could not be built
+            # If building failed, the traceback may still reference the canvas and keep the file open (it can not be removed on Windows),
+            # so a failed removal is only reported to not hide the original error
+            del canvas
+            try:
+                os.remove(dst + ".raw")
+            except OSError as error:
+                print("Could not remove " + dst + ".raw: " + str(error))
+
+        return
+
+    def _save_png(self, canvas: np.ndarray, path: str) -> None:
         """
-        Builds an histopathological image given its patches and its labels
+        Saves an RGB image as PNG, compressing it in strips of PNG_STRIP rows so the whole image is never held in memory
 
         Args:
-            dir (str): Path to the image patches
-            dst (str): Name of destination image
+            canvas (np.ndarray): RGB image to save
+            path (str): Path of the PNG file
 
-        Raises:
-            TypeError: The given path is not a string
-            TypeError: The given destination is not a string
-            OSError: The given path is not a directory
-        
         Returns:
             None
         """        
+        def write_chunk(file, chunk_type: bytes, data: bytes) -> None:
+            file.write(struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', zlib.crc32(chunk_type + data) & 0xFFFFFFFF))
 
-        if not os.path.isdir(dir): raise OSError ('"dir" is not a directory')
-        if not isinstance(dir, str): raise TypeError('"dir" must be a string')
-        if not isinstance(dst, str): raise TypeError('"dst" must be a string')
+        height, width = canvas.shape[:2]
+        compressor = zlib.compressobj(6)
 
-        # Get image paths
-        img_dir = os.listdir(dir)
+        # Previous row, needed by the "Up" filter of the first row of every strip
+        previous = np.zeros(width * 3, dtype = np.uint8)
 
-        x_list, y_list = [], []
-        max_x, max_y = 0, 0
-        for img in tqdm(img_dir, desc = "Gathering data..."):
-            
-            # Get image position
-            x, y = img[1:-10].split('y')
-            x,y = int(x [:-1]), int(y [:-1])
+        with open(path, 'wb') as file:
 
-            x_list.append(x)
-            y_list.append(y)
+            # Signature and header (8 bit RGB, no interlacing)
+            file.write(b'\x89PNG\r\n\x1a\n')
+            write_chunk(file, b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0))
 
-            if x > max_x:
-                max_x = x
-                
-            if y > max_y:
-                max_y = y
+            for start in range(0, height, PNG_STRIP):
+                rows = np.asarray(canvas[start:start + PNG_STRIP]).reshape(-1, width * 3)
 
-        # Make a blank image of size max_x and max_y
-        hist_image = Image.new(mode = 'RGB', size =  (max_x, max_y), color = (255,255,255))
+                # Every row is stored as its difference with the row above ("Up" filter, type 2)
+                filtered = np.empty((rows.shape[0], width * 3 + 1), dtype = np.uint8)
+                filtered[:, 0] = 2
+                filtered[0, 1:] = rows[0] - previous
+                filtered[1:, 1:] = rows[1:] - rows[:-1]
+                previous = rows[-1].copy()
 
-        # Green patch of size 50 x 50
-        malignant_patch = Image.new(mode = 'RGB', size =  (50, 50), color = (0,255,0))
+                data = compressor.compress(filtered.tobytes())
+                if data: write_chunk(file, b'IDAT', data)
 
-        for idx in tqdm(range(len(img_dir)), desc = "Building true labeled image..."):
-        
+            write_chunk(file, b'IDAT', compressor.flush())
+            write_chunk(file, b'IEND', b'')
 
-            if img_dir[idx] [-5] == "0":
+        return
 
-                # Open image
-                img = Image.open(dir + img_dir[idx])
+    def _morton_order(self, x_list: list, y_list: list) -> list:
+        """
+        Gets the order of the patches along the Z-order (Morton) curve of their positions
 
-                # Paste image at its position
-                hist_image.paste(img, (x_list[idx], y_list[idx]))
+        Args:
+            x_list (list): x coordinate of every patch
+            y_list (list): y coordinate of every patch
 
-            else:
-                hist_image.paste(malignant_patch, (x_list[idx], y_list[idx]))
+        Returns:
+            list: Indices that sort the patches
+        """        
+        def spread_bits(v: np.ndarray) -> np.ndarray:
 
-        # Save image
-        hist_image.save(dst + ".png")
-        return 
+            # Inserts a zero between every bit of the (16 bit) values
+            v = v & 0xFFFF
+            v = (v | (v << 8)) & 0x00FF00FF
+            v = (v | (v << 4)) & 0x0F0F0F0F
+            v = (v | (v << 2)) & 0x33333333
+            v = (v | (v << 1)) & 0x55555555
+            return v
 
-    def build_predicted_histopathological_image(self, dir: str, dst: str) -> None:
+        # Positions in patches instead of pixels
+        x = np.asarray(x_list, dtype = np.int64) // 50
+        y = np.asarray(y_list, dtype = np.int64) // 50
+
+        return np.argsort(spread_bits(x) | (spread_bits(y) << 1), kind = 'stable').tolist()
+
+    def _load_patch(self, path: str) -> np.ndarray:
         """
-        Builds an histopathological image given its patches using the model to predict the label
+        Opens and decodes a patch
 
         Args:
-            dir (str): Path to the image patches
-            dst (str): Name of destination image
+            path (str): Path to the patch
 
-        Raises:
-            TypeError: The given path is not a string
-            TypeError: The given destination is not a string
-            OSError: The given path is not a directory
+        Returns:
+            np.ndarray: The patch as an RGB array
+        """        
+        return np.asarray(load_image(path).convert('RGB'))
+
+    def _paste(self, canvas: np.ndarray, img: Union[Image.Image, np.ndarray], x: int, y: int) -> None:
+        """
+        Pastes a patch in the canvas at the given position, cropping it if it does not fit
+
+        Args:
+            canvas (np.ndarray): RGB image where the patch is pasted
+            img (Union[Image.Image, np.ndarray]): Patch to paste
+            x (int): x coordinate of the patch
+            y (int): y coordinate of the patch
 
         Returns:
             None
         """        
-        if not os.path.isdir(dir): raise OSError ('"dir" is not a directory')
-        if not isinstance(dir, str): raise TypeError('"dir" must be a string')
-        if not isinstance(dst, str): raise TypeError('"dst" must be a string')
+        if isinstance(img, Image.Image):
+            img = np.asarray(img if img.mode == 'RGB' else img.convert('RGB'))
 
-        # Get image paths
-        img_dir = os.listdir(dir)
+        height, width = img.shape[:2]
+        canvas[y:y + height, x:x + width] = img[:canvas.shape[0] - y, :canvas.shape[1] - x]
+        return
 
-        x_list, y_list = [], []
-        max_x, max_y = 0, 0
-        for img in tqdm(img_dir, desc = "Gathering data..."):
-            
-            # Get image position
-            x, y = img[1:-10].split('y')
-            x,y = int(x [:-1]), int(y [:-1])
+    def _paste_predicted(self, canvas: np.ndarray, dir: str, img_dir: list, x_list: list, y_list: list) -> None:
+        """
+        Predicts the label of every patch with the model and pastes it, or a green patch if it is malignant
 
-            x_list.append(x)
-            y_list.append(y)
+        Args:
+            canvas (np.ndarray): RGB image where the patches are pasted
+            dir (str): Path to the image patches
+            img_dir (list): List with the file names of the patches
+            x_list (list): x coordinate of every patch
+            y_list (list): y coordinate of every patch
+
+        Raises:
+            ValueError: A patch is not of size 50 x 50
 
-            if x > max_x:
-                max_x = x
-                
-            if y > max_y:
-                max_y = y
+        Returns:
+            None
+        """        
+        # Compile the model the first time it is used
+        if self.compile_pending:
+            self.compile_model()
 
-        # Make a blank image of size max_x and max_y
-        hist_image = Image.new(mode = 'RGB', size =  (max_x, max_y), color = (255,255,255))
+        # Patches are loaded and decoded by the workers (two batches ahead each) while the model is predicting
+        loader = DataLoader(PatchDataset(dir, img_dir), batch_size = BATCH_SIZE, num_workers = NUM_WORKERS,
+                            pin_memory = self.device == 'cuda')
 
-        # Green patch of size 50 x 50
-        malignant_patch = Image.new(mode = 'RGB', size =  (50, 50), color = (0,255,0))
+        # Batches whose predictions are being copied to the CPU
+        pending = []
 
         self.model.eval()
         with torch.no_grad():
-            for idx in tqdm(range(len(img_dir)), desc = "Building predicted image..."):
-                
-                # Open image
-                img = Image.open(dir + img_dir[idx])
+            for patches, idxs in tqdm(loader, desc = "Building predicted image..."):
 
-                # Transform to tensor
-                tensor = self.transforms(img).to(self.device)
+                # Send the batch as uint8 and normalize it on the device (NHWC permuted to NCHW is already channels last)
+                tensors = patches.to(self.device, non_blocking = True).permute(0, 3, 1, 2)
+                tensors = (tensors.to(self.mean.dtype) - self.mean) * self.inv_std
 
-                # Add an extra dimension to allow forwarding through the model
-                tensor = tensor[None]
+                # TensorRT and compiled models are specialized for full batches, so the last one is padded with zeros
+                if self.fixed_batch and tensors.shape[0] < BATCH_SIZE:
+                    tensors = F.pad(tensors, (0, 0, 0, 0, 0, 0, 0, BATCH_SIZE - tensors.shape[0]))
 
-                # Predict label
-                output = self.model(tensor)[:,:1].squeeze(1)
+                # Forward the whole batch through the model at once (sigmoid(x) > 0.5 is the same as x > 0)
+                preds = self.model(tensors)[:, 0] > 0
 
-                predicted = 1 if torch.sigmoid(output) > 0.5 else 0
+                # Copy the predictions to the CPU in another stream, so the next batch can be forwarded meanwhile
+                if self.d2h_stream is not None:
+                    self.d2h_stream.wait_stream(torch.cuda.current_stream())
+                    with torch.cuda.stream(self.d2h_stream):
+                        preds_cpu = torch.empty(preds.shape, dtype = preds.dtype, pin_memory = True)
+                        preds_cpu.copy_(preds, non_blocking = True)
+                        preds.record_stream(self.d2h_stream)
+                    pending.append((patches, idxs, preds_cpu, self.d2h_stream.record_event()))
 
-                # Prediction == Benign
-                if predicted == 0:
+                else:
+                    pending.append((patches, idxs, preds, None))
 
-                    # Paste image at its position
-                    hist_image.paste(img, (x_list[idx], y_list[idx]))
+                # Paste the previous batch, only waiting for its own copy
+                if len(pending) > 1:
+                    self._paste_batch(canvas, x_list, y_list, *pending.pop(0))
 
-                # Prediction == Malignant
-                else:
-                    hist_image.paste(malignant_patch, (x_list[idx], y_list[idx]))
+            for batch in pending:
+                self._paste_batch(canvas, x_list, y_list, *batch)
+
+        return
+
+    def _paste_batch(self, canvas: np.ndarray, x_list: list, y_list: list, patches: torch.Tensor,
+                     idxs: torch.Tensor, preds: torch.Tensor, event: torch.cuda.Event) -> None:
+        """
+        Pastes a batch of predicted patches, or a green patch for those that are malignant
+
+        Args:
+            canvas (np.ndarray): RGB image where the patches are pasted
+            x_list (list): x coordinate of every patch
+            y_list (list): y coordinate of every patch
+            patches (torch.Tensor): uint8 patches of the batch, of shape (batch, height, width, 3)
+            idxs (torch.Tensor): Index of every patch in the batch
+            preds (torch.Tensor): Prediction of every patch in the batch (True if malignant)
+            event (torch.cuda.Event): Event recorded after copying the predictions to the CPU, None if there was no copy
+
+        Returns:
+            None
+        """        
+        if event is not None:
+            event.synchronize()
+
+        for i, (idx, predicted) in enumerate(zip(idxs.tolist(), preds.tolist())):
+
+            # Prediction == Malignant
+            if predicted:
+                self._paste(canvas, self.MALIGNANT_PATCH, x_list[idx], y_list[idx])
+
+            # Prediction == Benign, paste image at its position
+            else:
+                self._paste(canvas, patches[i].numpy(), x_list[idx], y_list[idx])
+
+        return
 
-        # Save image
-        hist_image.save(dst + ".png")
+    def build_histopathological_image(self, dir: str, dst: str) -> None:
+        """
+        Builds an histopathological image given its patches
+
+        Args:
+            dir (str): Path to the image patches
+            dst (str): Name of destination image
 
-        return 
\ No newline at end of file
+        Raises:
+            TypeError: The given path is not a string
+            TypeError: The given destination is not a string
+            OSError: The given path is not a directory
+
+        Returns:
+            None
+        """        
+        return self._build('original', dir, dst)
+
+    def build_truelabel_histopathological_image(self, dir: str, dst: str) -> None:
+        """
+        Builds an histopathological image given its patches and its labels
+
+        Args:
+            dir (str): Path to the image patches
+            dst (str): Name of destination image
+
+        Raises:
+            TypeError: The given path is not a string
+            TypeError: The given destination is not a string
+            OSError: The given path is not a directory
+        
+        Returns:
+            None
+        """        
+        return self._build('true', dir, dst)
+
+    def build_predicted_histopathological_image(self, dir: str, dst: str) -> None:
+        """
+        Builds an histopathological image given its patches using the model to predict the label
+
+        Args:
+            dir (str): Path to the image patches
+            dst (str): Name of destination image
+
+        Raises:
+            TypeError: The given path is not a string
+            TypeError: The given destination is not a string
+            OSError: The given path is not a directory
+
+        Returns:
+            None
+        """        
+        return self._build('predicted', dir, dst)
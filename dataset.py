@@ -1,6 +1,13 @@
 # Image libraries
 from PIL import Image 
 
+# libjpeg-turbo is optional, PIL (or Pillow-SIMD, which is a drop-in replacement) is used if it is not installed
+try:
+    from turbojpeg import TurboJPEG, TJPF_RGB
+    turbo_jpeg = TurboJPEG()
+except (ImportError, RuntimeError):
+    turbo_jpeg = None
+
 # Path to images
 import glob
 from os import path
@@ -15,7 +22,24 @@ from torch.utils.data.dataset import Dataset
 
 # Utilities
 from typing import Tuple
-from torch import Tensor
+from torch import Tensor, from_numpy
+import numpy as np
+
+def load_image(img_path: str) -> Image.Image:
+    """
+    Opens an image, decoding it with libjpeg-turbo if it is a JPEG and it is available
+
+    Args:
+        img_path (str): Path to the image
+
+    Returns:
+        Image.Image: The opened image
+    """    
+    if turbo_jpeg is not None and img_path.lower().endswith(('.jpg', '.jpeg')):
+        with open(img_path, 'rb') as file:
+            return Image.fromarray(turbo_jpeg.decode(file.read(), pixel_format = TJPF_RGB))
+
+    return Image.open(img_path)
 
 class BreastCancerDataset(Dataset):
     def __init__(self, data_dir: str, transfs: transforms.transforms.Compose = transforms.Compose([ transforms.ToTensor(), transforms.Normalize((0.7595, 0.5646, 0.6882), (0.1497, 0.1970, 0.1428)) ]), 
@@ -68,8 +92,8 @@ class BreastCancerDataset(Dataset):
         # Get image name from list
         img_path = self.image_list[index]
 
-        # Open image with PIL
-        img = Image.open(img_path)
+        # Open image
+        img = load_image(img_path)
 
         # Apply transforms 
         tensor = self.transfs(img)
@@ -95,4 +119,47 @@ class BreastCancerDataset(Dataset):
         Returns:
             int: The length of the dataset
         """        
-        return self.data_len    
\ No newline at end of file
+        return self.data_len    
+
+class PatchDataset(Dataset):
+    def __init__(self, dir: str, img_dir: list):
+        """
+        Dataset for the patches of a single histopathological image, used to predict them in batches.
+        Patches are returned as uint8 HWC tensors, normalization is left to the device they are sent to.
+        All the patches must be of size 50 x 50 (setup_histimages.py removes the rest) so they can be batched.
+
+        Args:
+            dir (str): Path to the image patches
+            img_dir (list): List with the file names of the patches
+        """        
+        self.dir = dir
+        self.img_dir = img_dir
+
+    def __getitem__(self, index: int) -> Tuple[Tensor, int]:
+        """
+        Returns a patch given a index
+
+        Args:
+            index (int): The index of the patch
+
+        Raises:
+            ValueError: The patch is not of size 50 x 50, so it can not be batched with the others
+
+        Returns:
+            Tensor: The patch as a uint8 Tensor of shape (50, 50, 3)
+            int: The index of the patch, to know where it must be pasted
+        """        
+        img = load_image(self.dir + self.img_dir[index]).convert('RGB')
+
+        if img.size != (50, 50): raise ValueError('Patch "' + self.dir + self.img_dir[index] + '" must be of size 50 x 50, but it is ' + str(img.size[0]) + ' x ' + str(img.size[1]))
+
+        return (from_numpy(np.array(img)), index)
+
+    def __len__(self) -> int:
+        """
+        Returns the number of patches in the dataset
+
+        Returns:
+            int: The length of the dataset
+        """        
+        return len(self.img_dir)
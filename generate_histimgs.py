@@ -17,6 +17,9 @@ parser.add_argument('-p', '--path', dest = 'path', default = None, type=str, hel
 # Path to images
 parser.add_argument('-d', '--destination', dest = 'dest', default = None, type=str, help= 'Destination directory.')
 
+# Save tiled TIFF images
+parser.add_argument('-t', '--tiled', action= 'store_true', dest = 'tiled', default=False, help= 'Save the images as tiled TIFF files instead of PNG (requires tifffile)')
+
 def main():
 
     # Parse arguments
@@ -35,7 +38,7 @@ def main():
         model.load_state_dict(torch.load('./pretrained/EfficientNetB6.pth', map_location=torch.device('cpu')) ['model'])
 
     # Make HistopathologyImageMaker
-    histimgmaker = histmaker(model)
+    histimgmaker = histmaker(model, tiled_output = args.tiled)
 
     for dir in os.listdir(args.path):
 
@@ -8,97 +8,126 @@ import zipfile as zf
 import shutil
 import os
 
+# Parallel extraction and file moving
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
 # Utils
 from tqdm import tqdm
 from PIL import Image
+from typing import Tuple
 
 
+def extract_chunk(args: Tuple[str, list]) -> int:
+    """
+    Extracts some members of a zip file in the current directory
 
+    Args:
+        args (Tuple[str, list]): Path to the zip file and names of the members to extract
 
-# Create the necesary folders.
-# If "archive" directory already exists, it is overwritten
-data_folder = "./archive/"
-os.makedirs(data_folder,exist_ok=True)
-os.chdir(data_folder)
-print("Created data folder")
-print("Preparing to extract...")
-
-# Extract files from zip file
-with zf.ZipFile('../archive.zip','r') as arc:
-    for member in tqdm(arc.infolist(),desc='Extracting...'):
-        try:
-            arc.extract(member,'.')
-        except:
-            pass
+    Returns:
+        int: Number of members that could not be extracted
+    """    
+    path, names = args
 
+    failed = 0
+    with zf.ZipFile(path,'r') as arc:
+        for name in names:
+            try:
+                arc.extract(name,'.')
+            except Exception:
+                failed += 1
 
-os.chdir("..")
+    return failed
 
-# There is a folder named 'IDC_regular_ps50_idx5' in the zip file
-# However it is not necesary, so we just remove it
-for i in tqdm(os.listdir(data_folder + 'IDC_regular_ps50_idx5/'),desc = 'Removing unnecesary files...'):
-    shutil.rmtree(data_folder + 'IDC_regular_ps50_idx5/' + i)
+def process_fold(args: Tuple[str, str, int]) -> None:
+    """
+    Renames and moves the valid samples of a fold to the fold folder, removes the corrupted ones and renames the fold
 
-# Once files have been removed, we delete the directory   
-os.rmdir(data_folder + 'IDC_regular_ps50_idx5/')
+    Args:
+        args (Tuple[str, str, int]): Path to the data folder, name of the fold and its new name (index)
 
-dirs = os.listdir(data_folder)   
-
-img_idx = 1
-for fold in tqdm(dirs, desc= 'Renaming and moving files...'):
+    Returns:
+        None
+    """    
+    data_folder, fold, img_idx = args
 
     class_0_folder = data_folder + str(fold) + "/0/"
     class_1_folder = data_folder + str(fold) + "/1/"
 
-   # Class 0 samples
-    for img_name in os.listdir(class_0_folder):
-
-        # Open image
-        img = Image.open(class_0_folder + img_name)
+    # Class 0 and class 1 samples, each folder is listed once
+    for entry in [*os.scandir(class_0_folder), *os.scandir(class_1_folder)]:
 
         # Check size
-        if img.size [0] == 50 and img.size [1] == 50:
+        with Image.open(entry.path) as img:
+            valid = img.size [0] == 50 and img.size [1] == 50
+
+        if valid:
 
             # Form new name
-            aux = img_name.split("_")
+            aux = entry.name.split("_")
             new_name = '_'.join(aux[2:])
 
-            # Rename file and move
-            os.rename(class_0_folder + img_name, class_0_folder + new_name )
-            shutil.move(class_0_folder + new_name, data_folder + str(fold) + '/' + new_name)
+            # Rename and move file at once (same filesystem)
+            os.replace(entry.path, data_folder + str(fold) + '/' + new_name)
 
         else:
             # If file is corrupted, remove
-            os.remove(class_0_folder + img_name)
+            os.remove(entry.path)
 
-    # Class 1 samples
-    for img_name in os.listdir(class_1_folder):
+    # Remove the "0" and "1" folders
+    shutil.rmtree(class_0_folder)
+    shutil.rmtree(class_1_folder)
 
-        # Open image
-        img = Image.open(class_1_folder + img_name)
+    # Rename folder
+    os.rename(data_folder + str(fold), data_folder + str(img_idx))
+    return
 
-        # Check size
-        if img.size [0] == 50 and img.size [1] == 50:
+def main():
 
-            # Form new name
-            aux = img_name.split("_")
-            new_name = '_'.join(aux[2:])
+    # Create the necesary folders.
+    # If "archive" directory already exists, it is overwritten
+    data_folder = "./archive/"
+    os.makedirs(data_folder,exist_ok=True)
+    os.chdir(data_folder)
+    print("Created data folder")
+    print("Preparing to extract...")
 
-            # Rename file and move
-            os.rename(class_1_folder + img_name, class_1_folder + new_name)
-            shutil.move(class_1_folder + new_name, data_folder + str(fold) + '/' + new_name)
+    # Extract files from zip file, each process extracts a chunk of the members
+    with zf.ZipFile('../archive.zip','r') as arc:
+        names = arc.namelist()
 
-        else:
-            # If file is corrupted, remove
-            os.remove(class_1_folder + img_name)
+    # Folders are created beforehand so the processes do not race to create them
+    for folder in {os.path.dirname(name) for name in names}:
+        if folder: os.makedirs(folder, exist_ok=True)
 
-    # Remove the "0" and "1" folders
-    shutil.rmtree(class_0_folder)
-    shutil.rmtree(class_1_folder)
+    num_chunks = 4 * (os.cpu_count() or 1)
+    chunk_size = len(names) // num_chunks + 1
+    chunks = [('../archive.zip', names[i:i + chunk_size]) for i in range(0, len(names), chunk_size)]
 
-    # Renae folder and update index
-    os.rename(data_folder + str(fold), data_folder + str(img_idx))
-    img_idx += 1
-    
+    with ProcessPoolExecutor() as executor:
+        failed = sum(tqdm(executor.map(extract_chunk, chunks), total = len(chunks), desc='Extracting...'))
+
+    if failed > 0:
+        print("Could not extract " + str(failed) + " files")
+
+    os.chdir("..")
+
+    # There is a folder named 'IDC_regular_ps50_idx5' in the zip file
+    # However it is not necesary, so we just remove it
+    for i in tqdm(os.listdir(data_folder + 'IDC_regular_ps50_idx5/'),desc = 'Removing unnecesary files...'):
+        shutil.rmtree(data_folder + 'IDC_regular_ps50_idx5/' + i)
+
+    # Once files have been removed, we delete the directory   
+    os.rmdir(data_folder + 'IDC_regular_ps50_idx5/')
+
+    dirs = [entry.name for entry in os.scandir(data_folder) if entry.is_dir()]
+
+    # Folds are processed by a pool of threads, so the syscalls of some folds overlap with the scanning of others
+    with ThreadPoolExecutor(max_workers = 16) as executor:
+        tasks = [(data_folder, fold, img_idx) for img_idx, fold in enumerate(dirs, 1)]
+        list(tqdm(executor.map(process_fold, tasks), total = len(tasks), desc= 'Renaming and moving files...'))
+
+    print("Setup succesful")
 
-print("Setup succesful")
\ No newline at end of file
+if __name__ == "__main__":
+    main()
\ No newline at end of file